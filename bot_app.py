@@ -8,11 +8,13 @@ FlowManager с reply-клавиатурами. Файл использует `fl
 import os
 import re
 import time
-from flow_core import FlowManager, Step, logger, escape_md_v2
+import itertools
+from flow_core import FlowManager, Step, logger, escape_md_v2, REMOVE_KEYBOARD
 from typing import Dict, Any
 import admins
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
@@ -21,30 +23,66 @@ from aiogram.types import FSInputFile
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import json
 import asyncio
+import tempfile
 
 # Token (можно задать через переменную окружения BOT_TOKEN)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
 
+# Пути к статическим файлам бота вычисляются один раз при импорте
+_BASE_DIR = os.path.dirname(__file__)
+_SCREENSHOT1 = os.path.join(_BASE_DIR, "screenshot1.png")
+_SCREENSHOT2 = os.path.join(_BASE_DIR, "screenshot2.png")
+_PRACTICE_PDF = os.path.join(_BASE_DIR, "practice.pdf")
+
+
+def _input_file(path: str):
+    """FSInputFile для существующего файла, иначе None (FSInputFile можно переиспользовать между отправками)."""
+    return FSInputFile(path) if os.path.exists(path) else None
+
+
+_FSFILE_SCR1 = _input_file(_SCREENSHOT1)
+_FSFILE_SCR2 = _input_file(_SCREENSHOT2)
+_FSFILE_PDF = _input_file(_PRACTICE_PDF)
+
 router = Router()
 
 # Импортируем структурированные данные (удобно редактировать)
 from bot_text import SCRIPT_STEPS, SYSTEM_TEXTS  # файл bot_text.py должен содержать SCRIPT_STEPS dict and SYSTEM_TEXTS
 
+# Системные тексты не меняются во время работы — экранируем их для MarkdownV2 один раз
+_SYS = {k: escape_md_v2(v) for k, v in SYSTEM_TEXTS.items()}
+
+# Текст шага 9 отправляется пользователю после подтверждения оплаты
+_STEP9 = SCRIPT_STEPS.get("9", {})
+_STEP9_TEXT = escape_md_v2(_STEP9.get("text", ""), allow_markdown=bool(_STEP9.get("md_v2", False)))
+
+
+# Таблица замен для normalize_label: NBSP и типографские кавычки -> ASCII
+_NORM_TABLE = str.maketrans({
+    "\u00A0": " ",
+    "\u2019": "'",
+    "\u2018": "'",
+    "\u201c": '"',
+    "\u201d": '"',
+})
+_WS_RE = re.compile(r"\s+")
+
+
+# order_tag = <время запуска процесса>-<счётчик>, оба в hex: уникален и между перезапусками
+_ORDER_PREFIX = f"{int(time.time()):x}"
+_order_counter = itertools.count(1)
+
+
+def _next_order_tag() -> str:
+    return f"{_ORDER_PREFIX}-{next(_order_counter):x}"
+
 
 def normalize_label(s: str) -> str:
     """Normalize labels/messages for comparison: replace NBSP, normalize quotes, collapse whitespace, lower-case."""
     if s is None:
         return ""
-    text = str(s)
-    # replace non-breaking space and common unicode quotes with ASCII
-    text = text.replace("\u00A0", " ")
-    text = text.replace("\u2019", "'")
-    text = text.replace("\u2018", "'")
-    text = text.replace("\u201c", '"')
-    text = text.replace("\u201d", '"')
-    # collapse whitespace
-    text = re.sub(r"\s+", " ", text)
-    return text.strip().lower()
+    # replace non-breaking space and common unicode quotes with ASCII, then collapse whitespace
+    return _WS_RE.sub(" ", str(s).translate(_NORM_TABLE)).strip().lower()
 
 
 def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManager:
@@ -69,13 +107,16 @@ def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManag
         on_enter = None
         docname = info.get("document")
         if docname:
-            def make_on_enter(doc):
-                async def on_enter_fn(message: types.Message, state: FSMContext, meta: Dict[str, Any]):
-                    doc_path = os.path.join(os.path.dirname(__file__), doc)
-                    if os.path.exists(doc_path):
-                        await message.answer_document(FSInputFile(doc_path))
-                return on_enter_fn
-            on_enter = make_on_enter(docname)
+            # файл проверяем и оборачиваем в FSInputFile один раз при сборке потока
+            doc_file = _input_file(os.path.join(_BASE_DIR, docname))
+            if doc_file is None:
+                logger.warning("Document %s for step %s not found", docname, step_id)
+            else:
+                def make_on_enter(doc_file_local):
+                    async def on_enter_fn(message: types.Message, state: FSMContext, meta: Dict[str, Any]):
+                        await message.answer_document(doc_file_local)
+                    return on_enter_fn
+                on_enter = make_on_enter(doc_file)
 
         prefmt = bool(info.get("md_v2", False))
         if not answers:
@@ -86,14 +127,13 @@ def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManag
         # build reply keyboard: each answer on its own row
         reply_descr: list[list[str]] = [[ans["label"]] for ans in answers]
 
-        # create map normalized_label -> {orig, action}
-        action_map = {normalize_label(ans["label"]): {"orig": ans["label"], "action": ans.get("action", {})} for ans in answers}
+        # create map normalized_label -> (orig, action)
+        action_map = {normalize_label(ans["label"]): (ans["label"], ans.get("action", {})) for ans in answers}
 
-        def make_on_message(map_local):
+        def make_on_message(map_local, step_id_local):
             async def on_msg(message: types.Message, state: FSMContext, meta: Dict[str, Any]):
-                # Берём актуальные meta из состояния, т.к. он мог обновиться
-                ctx = await state.get_data()
-                user_meta = ctx.get("meta", {})
+                # meta уже прочитаны из состояния в handle_message для этого сообщения
+                user_meta = meta
 
                 # Если пользователь присылает фото и ранее указал, что оплатил,
                 # пересылаем чек админу и прикрепляем inline-кнопки для подтверждения.
@@ -108,19 +148,17 @@ def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManag
                             # Forward original message so админ увидит отправителя
                             await message.bot.forward_message(admin_id, message.chat.id, message.message_id)
                             # Send control message with inline buttons
-                            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-
                             kb = InlineKeyboardMarkup(inline_keyboard=[
                                 [InlineKeyboardButton(text="Подтвердить", callback_data=f"pay_confirm:{message.from_user.id}:{order_tag}"),
                                  InlineKeyboardButton(text="Отклонить", callback_data=f"pay_decline:{message.from_user.id}:{order_tag}")]
                             ])
                             await message.bot.send_message(admin_id, escape_md_v2(f"Платёж от user_id={message.from_user.id}, order={order_tag}, method={method}"), reply_markup=kb, parse_mode=ParseMode.MARKDOWN_V2)
-                            await message.answer(escape_md_v2(SYSTEM_TEXTS.get("receipt_sent")), parse_mode=ParseMode.MARKDOWN_V2)
+                            await message.answer(_SYS.get("receipt_sent", ""), parse_mode=ParseMode.MARKDOWN_V2)
                         except Exception:
-                            await message.answer(escape_md_v2(SYSTEM_TEXTS.get("receipt_send_failed")), parse_mode=ParseMode.MARKDOWN_V2)
+                            await message.answer(_SYS.get("receipt_send_failed", ""), parse_mode=ParseMode.MARKDOWN_V2)
                     else:
                         # Admin not configured — уведомим пользователя
-                        await message.answer(escape_md_v2(SYSTEM_TEXTS.get("no_admin")), parse_mode=ParseMode.MARKDOWN_V2)
+                        await message.answer(_SYS.get("no_admin", ""), parse_mode=ParseMode.MARKDOWN_V2)
                     # Снимаем pending метку
                     user_meta.pop("pending_payment", None)
                     await state.update_data({"meta": user_meta})
@@ -132,46 +170,40 @@ def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManag
                 act_entry = map_local.get(txt)
                 if not act_entry:
                     # Log unmatched text and available original labels for debugging
-                    try:
-                        ctx_now = await state.get_data()
-                        current_step = ctx_now.get("step")
-                    except Exception:
-                        current_step = None
-                    available = [v["orig"] for v in map_local.values()]
-                    logger.info(f"Unmatched reply from user={message.from_user.id} step={current_step} text_raw='{txt_raw[:200]}' normalized='{txt[:200]}' available_labels={available}")
-                    await message.answer(escape_md_v2(SYSTEM_TEXTS.get("use_buttons")), parse_mode=ParseMode.MARKDOWN_V2)
+                    available = [orig for orig, _ in map_local.values()]
+                    logger.info("Unmatched reply from user=%s step=%s text_raw='%s' normalized='%s' available_labels=%s", message.from_user.id, step_id_local, txt_raw[:200], txt[:200], available)
+                    await message.answer(_SYS.get("use_buttons", ""), parse_mode=ParseMode.MARKDOWN_V2)
                     return
-                act = act_entry.get("action")
+                _orig, act = act_entry
                 kind = act.get("type")
                 # Специальный кейс: пользователь нажал "оплатил ..." — помечаем, ждём чек
-                if txt.lower().startswith("оплатил"):
-                    order_tag = str(int(time.time()))
+                # (txt уже в нижнем регистре после normalize_label)
+                if txt.startswith("оплатил"):
+                    order_tag = _next_order_tag()
                     user_meta["pending_payment"] = {"order_tag": order_tag, "method": txt}
                     await state.update_data({"meta": user_meta})
                     # удаляем reply-клавиатуру, чтобы пользователь мог отправить фото без лишних кнопок
-                    await message.answer(escape_md_v2(SYSTEM_TEXTS.get("send_receipt_instr")), reply_markup=types.ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN_V2)
+                    await message.answer(_SYS.get("send_receipt_instr", ""), reply_markup=REMOVE_KEYBOARD, parse_mode=ParseMode.MARKDOWN_V2)
                     return
                 if kind == "goto":
                     await flow.start(message, state, act.get("target"))
                 elif kind == "screenshot":
                     # Отправляем два изображения по очереди (без медиагруппы) — надёжный вариант
-                    img1 = os.path.join(os.path.dirname(__file__), "screenshot1.png")
-                    img2 = os.path.join(os.path.dirname(__file__), "screenshot2.png")
-                    if os.path.exists(img1):
-                        await message.answer_photo(FSInputFile(img1))
-                    if os.path.exists(img2):
-                        await message.answer_photo(FSInputFile(img2))
+                    if _FSFILE_SCR1:
+                        await message.answer_photo(_FSFILE_SCR1)
+                    if _FSFILE_SCR2:
+                        await message.answer_photo(_FSFILE_SCR2)
                     # optional target: перейти дальше после отправки
                     if act.get("target"):
                         await flow.start(message, state, act.get("target"))
                 elif kind == "raw":
                     await message.answer(escape_md_v2(act.get("payload", "")), parse_mode=ParseMode.MARKDOWN_V2)
                 else:
-                    await message.answer(escape_md_v2(SYSTEM_TEXTS.get("unknown_action")), parse_mode=ParseMode.MARKDOWN_V2)
+                    await message.answer(_SYS.get("unknown_action", ""), parse_mode=ParseMode.MARKDOWN_V2)
 
             return on_msg
 
-        on_message = make_on_message(action_map)
+        on_message = make_on_message(action_map, step_id)
         step = Step(id=step_id, text=text, reply_keyboard_descriptor=reply_descr, on_message=on_message, on_enter=on_enter, preformatted_md=prefmt)
         flow.add_step(step)
 
@@ -182,32 +214,142 @@ def build_flow_from_struct(steps_struct: Dict[str, Dict[str, Any]]) -> FlowManag
 script_flow = build_flow_from_struct(SCRIPT_STEPS)
 
 
-# Simple persistence for list of users who interacted with the bot
-USERS_FILE = os.path.join(os.path.dirname(__file__), "users.json")
+# Simple persistence for list of users who interacted with the bot.
+# Формат: один user_id на строку; новые id дописываются в конец файла,
+# полная перезапись (компактизация) выполняется только при старте.
+USERS_FILE = os.path.join(_BASE_DIR, "users.txt")
+# Старый формат (JSON-массив); читается только для миграции, если users.txt ещё нет
+LEGACY_USERS_FILE = os.path.join(_BASE_DIR, "users.json")
 
 def load_users() -> set:
+    users = set()
     try:
         if os.path.exists(USERS_FILE):
             with open(USERS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return set(int(x) for x in data)
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        users.add(int(line))
+                    except ValueError:
+                        # недописанная строка после аварийной остановки
+                        continue
+        elif os.path.exists(LEGACY_USERS_FILE):
+            with open(LEGACY_USERS_FILE, "r", encoding="utf-8") as f:
+                users.update(int(x) for x in json.load(f))
     except Exception:
         pass
-    return set()
+    return users
 
-def save_users(users: set):
+def save_users(users: set) -> bool:
+    # Пишем во временный файл и атомарно подменяем, чтобы не получить обрезанный users.txt
+    tmp_path = None
     try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(sorted(list(users)), f, ensure_ascii=False)
+        fd, tmp_path = tempfile.mkstemp(prefix=".users.", suffix=".tmp", dir=os.path.dirname(USERS_FILE) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(f"{uid}\n" for uid in users)
+        os.replace(tmp_path, USERS_FILE)
+        return True
     except Exception:
         logger.exception("Failed to save users file")
+        if tmp_path and os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+        return False
+
+def append_users(uids: list) -> bool:
+    try:
+        with open(USERS_FILE, "a", encoding="utf-8") as f:
+            f.writelines(f"{uid}\n" for uid in uids)
+        return True
+    except Exception:
+        logger.exception("Failed to append to users file")
+        return False
+
+
+# Пользователи держатся в памяти; новые id копятся в _users_pending
+# и дописываются в файл фоновой задачей _flusher
+_users: set = load_users()
+_users_pending: list = []
+USERS_FLUSH_INTERVAL = 5  # seconds
 
 def add_user(uid: int):
-    users = load_users()
-    if uid not in users:
-        users.add(int(uid))
-        save_users(users)
+    uid = int(uid)
+    if uid not in _users:
+        _users.add(uid)
+        _users_pending.append(uid)
+
+def flush_users():
+    global _users_pending
+    if not _users_pending:
+        return
+    pending, _users_pending = _users_pending, []
+    if not append_users(pending):
+        # повторим при следующем тике
+        _users_pending = pending + _users_pending
+
+def compact_users():
+    """Перезаписывает users.txt из памяти: убирает дубли и недописанные строки, мигрирует users.json."""
+    global _users_pending
+    if save_users(set(_users)):
+        _users_pending = []
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        flush_users()
+
 
+# Telegram ограничивает бота ~30 сообщениями в секунду суммарно
+BROADCAST_CONCURRENCY = 30
+
+async def _broadcast(bot: Bot, users, payload: str) -> int:
+    """Рассылает payload пользователям параллельно, не быстрее BROADCAST_CONCURRENCY сообщений в секунду.
+
+    Возвращает количество успешно отправленных сообщений.
+    """
+    text = escape_md_v2(payload)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    async def send_one(uid: int):
+        # при flood control (429) ждём retry_after и пробуем ещё раз, один раз
+        for attempt in range(2):
+            async with sem:
+                started = loop.time()
+                try:
+                    await bot.send_message(int(uid), text, parse_mode=ParseMode.MARKDOWN_V2)
+                    return
+                except TelegramRetryAfter as e:
+                    if attempt:
+                        raise
+                    retry_after = e.retry_after
+                finally:
+                    # держим слот не меньше секунды, даже если отправка упала,
+                    # чтобы не превысить лимит Telegram
+                    delay = 1.0 - (loop.time() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            await asyncio.sleep(retry_after)
+
+    # снимок множества: add_user может добавлять id, пока идёт рассылка
+    users = list(users)
+    results = await asyncio.gather(*(send_one(uid) for uid in users), return_exceptions=True)
+    sent = 0
+    for uid, res in zip(users, results):
+        if isinstance(res, Exception):
+            logger.error(f"Failed to send broadcast to user={uid}", exc_info=res)
+        else:
+            sent += 1
+    return sent
+
+
+async def do_broadcast(bot: Bot, payload: str) -> int:
+    """Рассылает payload всем известным пользователям; возвращает число отправленных."""
+    return await _broadcast(bot, _users, payload)
 
 
 @router.message(Command("start"))
@@ -222,6 +364,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 @router.message(lambda message: not (message.text and message.text.startswith("/")))
 async def all_messages(message: types.Message, state: FSMContext):
+    # FSM-данные читаем один раз и используем во всём обработчике
+    ctx: Dict[str, Any] = {}
     # Verbose logging for debugging: record raw incoming message and FSM meta
     try:
         ctx = await state.get_data()
@@ -229,15 +373,14 @@ async def all_messages(message: types.Message, state: FSMContext):
         uid = user.id if user else None
         username = user.username if user else None
         chat_id = message.chat.id if message.chat else None
-        text_repr = repr(message.text) if hasattr(message, "text") else "<no-text>"
-        logger.debug(f"INCOMING message uid={uid} username={username} chat_id={chat_id} text={text_repr} ctx={ctx}")
+        logger.debug("INCOMING message uid=%s username=%s chat_id=%s text=%r ctx=%s", uid, username, chat_id, message.text, ctx)
     except Exception:
         logger.exception("Failed to log incoming message or fetch FSM meta")
 
     # Don't intercept commands here — let command handlers run (still log them)
     try:
         if message.text and message.text.startswith("/"):
-            logger.debug(f"Ignoring command in all_messages: {message.text}")
+            logger.debug("Ignoring command in all_messages: %s", message.text)
             return
     except Exception:
         pass
@@ -258,14 +401,7 @@ async def all_messages(message: types.Message, state: FSMContext):
                 payload = text.split(" ", 1)[1].strip()
                 if payload:
                     logger.info(f"Admin requested immediate broadcast: len={len(payload)}")
-                    users = load_users()
-                    sent = 0
-                    for uid in sorted(users):
-                        try:
-                            await message.bot.send_message(int(uid), escape_md_v2(payload), parse_mode=ParseMode.MARKDOWN_V2)
-                            sent += 1
-                        except Exception:
-                            logger.exception(f"Failed to send broadcast to user={uid}")
+                    sent = await do_broadcast(message.bot, payload)
                     await message.answer(f"Рассылка выполнена. Отправлено: {sent} пользователям.")
                 else:
                     await message.answer("Пустое сообщение рассылки, отмена.")
@@ -277,21 +413,13 @@ async def all_messages(message: types.Message, state: FSMContext):
 
     # If admin previously started /broadcast and we're awaiting their payload, handle it here
     try:
-        ctx = await state.get_data()
         if ctx.get("awaiting_broadcast") and message.from_user and message.from_user.id == admins.ADMIN_ID:
             payload = (message.text or "").strip()
             if not payload:
                 await message.answer("Пустое сообщение рассылки. Отправьте текст или отмените.")
             else:
                 logger.info(f"Processing admin broadcast payload (len={len(payload)})")
-                users = load_users()
-                sent = 0
-                for uid in sorted(users):
-                    try:
-                        await message.bot.send_message(int(uid), escape_md_v2(payload), parse_mode=ParseMode.MARKDOWN_V2)
-                        sent += 1
-                    except Exception:
-                        logger.exception(f"Failed to send broadcast to user={uid}")
+                sent = await do_broadcast(message.bot, payload)
                 await message.answer(f"Рассылка выполнена. Отправлено: {sent} пользователям.")
                 # clear awaiting flag
                 try:
@@ -303,9 +431,8 @@ async def all_messages(message: types.Message, state: FSMContext):
         logger.exception("Error while handling awaiting_broadcast payload")
 
     try:
-        ctx = await state.get_data()
         if ctx.get("flow") == script_flow.name:
-            await script_flow.handle_message(message, state)
+            await script_flow.handle_message(message, state, ctx=ctx)
     except Exception:
         logger.exception("Error while delegating message to script_flow.handle_message")
 
@@ -336,14 +463,7 @@ async def cmd_broadcast(message: types.Message, state: FSMContext):
         if not payload:
             await message.answer("Пустое сообщение рассылки, отмена.")
             return
-        users = load_users()
-        sent = 0
-        for uid in sorted(users):
-            try:
-                await message.bot.send_message(int(uid), escape_md_v2(payload), parse_mode=ParseMode.MARKDOWN_V2)
-                sent += 1
-            except Exception:
-                logger.exception(f"Failed to send broadcast to user={uid}")
+        sent = await do_broadcast(message.bot, payload)
         await message.answer(f"Рассылка выполнена. Отправлено: {sent} пользователям.")
         return
 
@@ -360,14 +480,13 @@ async def cmd_broadcast(message: types.Message, state: FSMContext):
     await message.answer(instr)
 
 
-@router.callback_query(lambda c: c.data and c.data.startswith("pay_confirm:"))
 async def cb_pay_confirm(callback: types.CallbackQuery, state: FSMContext):
     # callback_data format: pay_confirm:<user_id>:<order_tag>
-    data = callback.data.split(":")
-    if len(data) < 3:
+    _prefix, _, rest = callback.data.partition(":")
+    user_id_str, _, order_tag = rest.partition(":")
+    if not order_tag:
         await callback.answer()
         return
-    _, user_id_str, order_tag = data[0], data[1], data[2]
     try:
         admin_id = admins.ADMIN_ID
         if callback.from_user.id != admin_id:
@@ -375,16 +494,12 @@ async def cb_pay_confirm(callback: types.CallbackQuery, state: FSMContext):
             return
         user_id = int(user_id_str)
         # send document to user if exists
-        pdf_path = os.path.join(os.path.dirname(__file__), "practice.pdf")
-        if os.path.exists(pdf_path):
-            await callback.bot.send_document(user_id, FSInputFile(pdf_path))
+        if _FSFILE_PDF:
+            await callback.bot.send_document(user_id, _FSFILE_PDF)
             await callback.message.answer(escape_md_v2(SYSTEM_TEXTS.get("payment_confirmed_admin_notify").format(user_id=user_id, order_tag=order_tag)), parse_mode=ParseMode.MARKDOWN_V2)
             try:
-                    # send the official step-9 text to the user (preserve markdown if step marked md_v2)
-                    text9 = SCRIPT_STEPS.get("9", {}).get("text", "")
-                    # If the step is intended to keep MarkdownV2 formatting, allow it when escaping
-                    allow_md = bool(SCRIPT_STEPS.get("9", {}).get("md_v2", False))
-                    await callback.bot.send_message(user_id, escape_md_v2(text9, allow_markdown=allow_md), parse_mode=ParseMode.MARKDOWN_V2)
+                    # send the official step-9 text to the user (pre-escaped, markdown kept if step marked md_v2)
+                    await callback.bot.send_message(user_id, _STEP9_TEXT, parse_mode=ParseMode.MARKDOWN_V2)
             except Exception:
                 # user might have blocked bot; ignore
                 pass
@@ -394,25 +509,41 @@ async def cb_pay_confirm(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
 
 
-@router.callback_query(lambda c: c.data and c.data.startswith("pay_decline:"))
 async def cb_pay_decline(callback: types.CallbackQuery, state: FSMContext):
     # callback_data format: pay_decline:<user_id>:<order_tag>
-    data = callback.data.split(":")
-    if len(data) < 3:
+    _prefix, _, rest = callback.data.partition(":")
+    user_id_str, _, order_tag = rest.partition(":")
+    if not order_tag:
         await callback.answer()
         return
-    _, user_id_str, order_tag = data[0], data[1], data[2]
     admin_id = admins.ADMIN_ID
     if callback.from_user.id != admin_id:
         await callback.answer("Only admin can decline payments.")
         return
     user_id = int(user_id_str)
     try:
-        await callback.bot.send_message(user_id, escape_md_v2(SYSTEM_TEXTS.get("payment_declined_user")), parse_mode=ParseMode.MARKDOWN_V2)
+        await callback.bot.send_message(user_id, _SYS.get("payment_declined_user", ""), parse_mode=ParseMode.MARKDOWN_V2)
         await callback.message.answer(escape_md_v2(f"Отклонено администратором для user={user_id} order={order_tag}"), parse_mode=ParseMode.MARKDOWN_V2)
     finally:
         await callback.answer()
 
+
+# callback_data имеет вид <prefix>:<...>; обработчик выбирается по префиксу
+_CB_ROUTES = {
+    "pay_confirm": cb_pay_confirm,
+    "pay_decline": cb_pay_decline,
+}
+
+
+@router.callback_query()
+async def on_callback(callback: types.CallbackQuery, state: FSMContext):
+    prefix, _, _rest = (callback.data or "").partition(":")
+    handler = _CB_ROUTES.get(prefix)
+    if handler is None:
+        await callback.answer()
+        return
+    await handler(callback, state)
+
 def create_dispatcher() -> Dispatcher:
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
@@ -429,9 +560,13 @@ async def main():
     except Exception as e:
         logger.warning(f"Could not delete webhook before polling: {e}")
     dp = create_dispatcher()
+    compact_users()
+    flusher_task = asyncio.create_task(_flusher())
     try:
         await dp.start_polling(bot)
     finally:
+        flusher_task.cancel()
+        flush_users()
         await bot.session.close()
 
 
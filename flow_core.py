@@ -8,12 +8,13 @@ flow_core.py
 - Step: dataclass, описывает один шаг
 - FlowManager: управляет переходами между шагами и делегирует сообщения/нажатия
 - build_reply_keyboard: утилита для создания ReplyKeyboardMarkup
+- REMOVE_KEYBOARD: общий экземпляр ReplyKeyboardRemove
 
 Принцип: кнопки reply отправляют текст как сообщение. FlowManager ожидает,
 что on_message каждого шага будет обрабатывать текстовые ответы (например,
 сопоставлять текст кнопки с действием и переходитьна нужный шаг).
 """
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any, Callable, Dict, List, Optional
 
 import logging
@@ -27,8 +28,10 @@ from aiogram.enums import ParseMode
 
 # Configure module-level logger writing to bot.log in the project directory.
 # Ensure a FileHandler exists that writes to bot.log even if other handlers were added.
+# Уровень задаётся переменной окружения LOG_LEVEL (по умолчанию INFO).
+LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
 logger = logging.getLogger("bot")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 log_path = os.path.join(os.path.dirname(__file__), "bot.log")
 try:
     # Check whether a FileHandler for our log_path already exists
@@ -49,12 +52,15 @@ try:
     logger.propagate = False
 except Exception:
     # If anything fails during logger setup, fallback to basicConfig to ensure logging works
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=LOG_LEVEL)
+
+# ReplyKeyboardRemove не имеет состояния — переиспользуем один экземпляр
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
 
 HandlerCallable = Callable[[types.Message, FSMContext, Dict[str, Any]], Any]
 
 
-@dataclass
+@dataclass(slots=True)
 class Step:
     """Описывает шаг потока.
 
@@ -71,6 +77,10 @@ class Step:
     on_enter: Optional[HandlerCallable] = None
     on_message: Optional[HandlerCallable] = None
     preformatted_md: bool = False
+    # Готовая reply-клавиатура: одинакова для всех пользователей, строится один раз
+    _cached_markup: Optional[ReplyKeyboardMarkup] = field(default=None, init=False, repr=False)
+    # Экранированный для MarkdownV2 текст; заполняется в add_step, если text — строка
+    _escaped_text: Optional[str] = field(default=None, init=False, repr=False)
 
 
 class FlowManager:
@@ -89,10 +99,13 @@ class FlowManager:
 
     def add_step(self, step: Step):
         self.steps[step.id] = step
-        logger.info(f"add_step id={step.id}")
+        # Статический текст экранируем один раз, а не при каждом входе в шаг
+        if isinstance(step.text, str):
+            step._escaped_text = escape_md_v2(step.text, allow_markdown=bool(step.preformatted_md))
+        logger.debug("add_step id=%s", step.id)
 
     def get_step(self, step_id: str) -> Optional[Step]:
-        logger.info(f"get_step id={step_id}")
+        logger.debug("get_step id=%s", step_id)
         return self.steps.get(step_id)
 
     async def start(self, message: types.Message, state: FSMContext, step_id: str):
@@ -102,53 +115,65 @@ class FlowManager:
             await message.answer(escape_md_v2("Шаг не найден: " + step_id), parse_mode=ParseMode.MARKDOWN_V2)
             return
         # Сохраняем контекст потока
-        await state.update_data({"flow": self.name, "step": step_id, "meta": {}})
-        logger.info(f"start user={message.from_user.id} step={step_id}")
-        await self._enter_step(message, state, step)
-
-    async def _enter_step(self, message: types.Message, state: FSMContext, step: Step):
-        # Получаем meta-данные
-        ctx = await state.get_data()
-        meta = ctx.get("meta", {})
+        meta: Dict[str, Any] = {}
+        await state.update_data({"flow": self.name, "step": step_id, "meta": meta})
+        logger.info("start user=%s step=%s", message.from_user.id, step_id)
+        await self._enter_step(message, state, step, meta=meta)
+
+    async def _enter_step(self, message: types.Message, state: FSMContext, step: Step,
+                          meta: Optional[Dict[str, Any]] = None):
+        # Получаем meta-данные (если вызывающий их ещё не прочитал)
+        if meta is None:
+            ctx = await state.get_data()
+            meta = ctx.get("meta", {})
         # Формируем текст
         text = step.text(meta) if callable(step.text) else (step.text or "")
-        logger.info(f"_enter_step user={message.from_user.id} step={step.id}")
+        logger.debug("_enter_step user=%s step=%s", message.from_user.id, step.id)
         # Формируем reply-клавиатуру
         # build reply keyboard; if none specified, remove any existing keyboard
         if step.reply_keyboard_descriptor:
-            kb = [[KeyboardButton(text=c) for c in row] for row in step.reply_keyboard_descriptor]
-            reply_kb = ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
-            logger.debug(f"reply options for step={step.id}: {step.reply_keyboard_descriptor}")
+            if step._cached_markup is None:
+                step._cached_markup = build_reply_keyboard(step.reply_keyboard_descriptor)
+            reply_kb = step._cached_markup
+            logger.debug("reply options for step=%s: %s", step.id, step.reply_keyboard_descriptor)
         else:
-            reply_kb = ReplyKeyboardRemove()
+            reply_kb = REMOVE_KEYBOARD
         # Вызываем hook on_enter
         if step.on_enter:
-            logger.info(f"call on_enter for step={step.id} user={message.from_user.id}")
+            logger.debug("call on_enter for step=%s user=%s", step.id, message.from_user.id)
             await step.on_enter(message, state, meta)
         # Отправляем основной текст (если задан)
         if text:
-            logger.info(f"send text for step={step.id} user={message.from_user.id}")
+            logger.debug("send text for step=%s user=%s", step.id, message.from_user.id)
             # escape for MarkdownV2; preserve markdown markers if step is preformatted
-            try:
-                esc = escape_md_v2(text, allow_markdown=bool(step.preformatted_md))
-            except Exception:
-                esc = text
+            if step._escaped_text is not None:
+                esc = step._escaped_text
+            else:
+                try:
+                    esc = escape_md_v2(text, allow_markdown=bool(step.preformatted_md))
+                except Exception:
+                    esc = text
             await message.answer(esc, reply_markup=reply_kb, parse_mode=ParseMode.MARKDOWN_V2)
 
-    async def handle_message(self, message: types.Message, state: FSMContext):
-        """Делегирует входящее сообщение соответствующему шагу (on_message)."""
-        ctx = await state.get_data()
+    async def handle_message(self, message: types.Message, state: FSMContext,
+                             ctx: Optional[Dict[str, Any]] = None):
+        """Делегирует входящее сообщение соответствующему шагу (on_message).
+
+        ctx — уже прочитанные данные FSM; если не переданы, читаются из state.
+        """
+        if ctx is None:
+            ctx = await state.get_data()
         current_step_id = ctx.get("step")
         if not current_step_id:
             # Пользователь не в потоке
             return
         step = self.get_step(current_step_id)
         if step and step.on_message:
-            logger.info(f"handle_message user={message.from_user.id} step={current_step_id} text={message.text}")
+            logger.info("handle_message user=%s step=%s text=%s", message.from_user.id, current_step_id, message.text)
             await step.on_message(message, state, ctx.get("meta", {}))
         else:
             # Если обработчика нет — информируем пользователя
-            logger.info(f"no handler for step={current_step_id} user={message.from_user.id}")
+            logger.info("no handler for step=%s user=%s", current_step_id, message.from_user.id)
             await message.answer(escape_md_v2("Пожалуйста, используйте кнопки на клавиатуре."), parse_mode=ParseMode.MARKDOWN_V2)
 
 
@@ -159,6 +184,14 @@ def build_reply_keyboard(descriptor: List[List[str]], resize: bool = True) -> Re
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=resize)
 
 
+# Base set of characters to escape in MarkdownV2 (always escaped)
+_MD_BASE_RE = re.compile(r"([\\\[\]\(\)\~\`\>\#\+\-\=\|\{\}\.\!])")
+# Bold/italic markers, escaped unless markdown is allowed
+_MD_BOLDITAL_RE = re.compile(r"([_*])")
+# Any character that escape_md_v2 may touch; used for the no-op fast path
+_MD_NEEDS_ESCAPE = re.compile(r"[\\\[\]\(\)\~\`\>\#\+\-\=\|\{\}\.\!_*]")
+
+
 def escape_md_v2(text: str, allow_markdown: bool = False) -> str:
     """Escape text for Telegram MarkdownV2.
 
@@ -166,41 +199,24 @@ def escape_md_v2(text: str, allow_markdown: bool = False) -> str:
     """
     if not isinstance(text, str):
         return text
+    # Nothing to escape — return the string as is
+    if not _MD_NEEDS_ESCAPE.search(text):
+        return text
 
-    # Base set of characters to escape in MarkdownV2 (always escaped)
-    base_pattern = re.compile(r"([\\\[\]\(\)\~\`\>\#\+\-\=\|\{\}\.\!])")
-    escaped = base_pattern.sub(lambda m: "\\" + m.group(1), text)
+    escaped = _MD_BASE_RE.sub(r"\\\1", text)
 
     # If markdown is not allowed at all, also escape '*' and '_'
     if not allow_markdown:
-        escaped = re.sub(r"([_*])", lambda m: "\\" + m.group(1), escaped)
-        return escaped
+        return _MD_BOLDITAL_RE.sub(r"\\\1", escaped)
 
-    # If markdown is allowed, attempt to keep '*' and '_' unescaped only when they form pairs.
-    # Strategy: find positions of '*' and '_' in the original text, pair them left-to-right.
-    # Unpaired trailing marker will be escaped to avoid Telegram parse errors.
+    # If markdown is allowed, keep '*' and '_' unescaped only when they form pairs.
+    # Markers pair up left-to-right, so only the last one can be unpaired (odd count);
+    # it is escaped to avoid Telegram parse errors.
     def preserve_pairs(s: str, marker: str) -> str:
-        positions = [i for i, ch in enumerate(s) if ch == marker]
-        if not positions:
+        if s.count(marker) % 2 == 0:
             return s
-        # Determine which positions should be left unescaped: pair them (0,1),(2,3)...
-        allow_pos = set()
-        for i in range(0, len(positions) - 1, 2):
-            allow_pos.add(positions[i])
-            allow_pos.add(positions[i+1])
-
-        # If odd count, last pos is unpaired and must be escaped
-        # Build new string: escape marker if its position not in allow_pos
-        out = []
-        for idx, ch in enumerate(s):
-            if ch == marker:
-                if idx in allow_pos:
-                    out.append(ch)
-                else:
-                    out.append("\\" + ch)
-            else:
-                out.append(ch)
-        return "".join(out)
+        last = s.rfind(marker)
+        return s[:last] + "\\" + s[last:]
 
     # Apply pairing logic to '*' and '_'
     result = preserve_pairs(escaped, '*')